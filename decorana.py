@@ -1,14 +1,22 @@
 import numpy as np
 import pandas as pd
+import asyncio
 import shutil
+import tempfile
+import hashlib
+import platform
 import subprocess
+import threading
 import os
 import matplotlib.pyplot as plt
 
 from pathlib import Path
 
+# serializes compilation, so threads do not build the same executable at once
+__compile_lock = threading.Lock()
 
-def decorana(data, iweight=0, iresc=0, ira=0, mk=0, short=0):
+
+def decorana(data, iweight=0, iresc=0, ira=0, mk=0, short=0, fast_math=False):
     """Detrended correspondence analysis and basic reciprocal averaging.
 
     This function performs detrended correspondence analysis and basic
@@ -18,6 +26,10 @@ def decorana(data, iweight=0, iresc=0, ira=0, mk=0, short=0):
 
     Parts of this function has been adopted from https://github.com/maurobio/cornpy.
 
+    Each call runs the program in its own temporary directory, so several
+    analyses can be run in parallel, e.g. with
+    ``concurrent.futures.ProcessPoolExecutor().map(decorana, dfs)``.
+
     Args:
         data (pd.DataFrame): A pandas dataframe
         iweigh (int): Downweighting of rare species (default = 0: no)
@@ -25,6 +37,7 @@ def decorana(data, iweight=0, iresc=0, ira=0, mk=0, short=0):
         ira	(int): Type of analysis (0: detrended, 1: basic reciprocal averaging, default = 0)
         mk (int): Number of segments in rescaling (default = 0)
         short (int): Shortest gradient to be rescaled (default = 0)
+        fast_math (bool): Compile with -ffast-math, which may change the scores slightly (default = False)
 
     Returns:
         site_scores (np.ndarray): array of site scores
@@ -33,49 +46,80 @@ def decorana(data, iweight=0, iresc=0, ira=0, mk=0, short=0):
         species_labels (list): list of species labels
     """
     # compile program
-    executable_path = __compile_fortran()
-
-    # write params.dat and cep.dat
-    nrows, ncols, row_lab, col_lab = __write_cep(data)
-    with open('params.dat', 'w') as parfile:
-        content = f"""cep.dat
-        -1
-        0
-        {iweight}
-        {iresc}
-        {ira}
-        {mk}
-        {short}
-        1
-        0
-        """
-        parfile.write(content)
-
-    # call decorana executable
-    process_result = subprocess.run(f'{executable_path} < params.dat',
-                                    shell=True,
-                                    stdout=subprocess.DEVNULL,
-                                    stderr=subprocess.DEVNULL)
-    if process_result.returncode != 0:
-        raise Exception(f'decorana.exe exited with code {process_result.returncode}!')
-
-    # remove decorana executable, params.dat and cep.dat
-    os.remove('decorana.exe')
-    os.remove('cep.dat')
-    os.remove('params.dat')
-
-    # read site and species scores
-    site_scores = np.genfromtxt('decorana.out', usecols=(0, 1, 2, 3), max_rows=nrows)
-    species_scores = np.genfromtxt([s[41:] for s in open('decorana.out')], usecols=(0, 1, 2, 3), max_rows=ncols)
-
-    # remove decorana.out and decorana.prt
-    os.remove('decorana.out')
-    os.remove('decorana.prt')
+    executable_path = __compile_fortran(fast_math=fast_math)
+
+    # run the program in a temporary directory, so concurrent calls do not collide
+    with tempfile.TemporaryDirectory() as tmpdir:
+        workdir = Path(tmpdir)
+        params, nrows, ncols, row_lab, col_lab = __prepare_run(data, workdir, iweight, iresc, ira, mk, short)
+
+        # call decorana executable, passing the parameters on stdin
+        process_result = subprocess.run([executable_path],
+                                        input=params,
+                                        cwd=workdir,
+                                        stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.DEVNULL)
+        site_scores, species_scores = __finish_run(process_result.returncode, workdir, nrows, ncols)
 
     # return scores and labels
     return site_scores, species_scores, row_lab, col_lab
 
 
+async def decorana_async(data, iweight=0, iresc=0, ira=0, mk=0, short=0, fast_math=False):
+    """Asynchronous version of decorana.
+
+    The decorana executable is started with asyncio.create_subprocess_exec, so
+    the event loop can run other analyses while the program is running. See
+    decorana for a description of the arguments and return values.
+    """
+    # compile program without blocking the event loop, concurrent calls wait for a single build
+    loop = asyncio.get_running_loop()
+    executable_path = await loop.run_in_executor(None, __compile_fortran, 'decorana.f', fast_math)
+
+    # run the program in a temporary directory, so concurrent calls do not collide
+    with tempfile.TemporaryDirectory() as tmpdir:
+        workdir = Path(tmpdir)
+        params, nrows, ncols, row_lab, col_lab = __prepare_run(data, workdir, iweight, iresc, ira, mk, short)
+
+        # call decorana executable, passing the parameters on stdin
+        process = await asyncio.create_subprocess_exec(executable_path,
+                                                       stdin=asyncio.subprocess.PIPE,
+                                                       stdout=asyncio.subprocess.DEVNULL,
+                                                       stderr=asyncio.subprocess.DEVNULL,
+                                                       cwd=workdir)
+        try:
+            await process.communicate(params)
+        except asyncio.CancelledError:
+            # stop decorana before its temporary directory is removed
+            process.kill()
+            await process.wait()
+            raise
+        site_scores, species_scores = __finish_run(process.returncode, workdir, nrows, ncols)
+
+    # return scores and labels
+    return site_scores, species_scores, row_lab, col_lab
+
+
+def decorana_many(datas, max_workers=None, **kwargs):
+    """Runs decorana on several dataframes concurrently.
+
+    Up to max_workers decorana processes are run at the same time, e.g. for
+    parameter sweeps or bootstrap resampling.
+
+    Args:
+        datas (list): list of pandas dataframes
+        max_workers (int): maximum number of concurrent runs (default = None: number of CPUs)
+        **kwargs: parameters passed to decorana_async for every dataframe
+
+    Returns:
+        results (list): list of (site_scores, species_scores, site_labels, species_labels)
+        tuples in the order of datas
+    """
+    # compile program once before starting the concurrent runs
+    __compile_fortran(fast_math=kwargs.get('fast_math', False))
+    return asyncio.run(__gather_decorana(datas, max_workers or os.cpu_count() or 1, kwargs))
+
+
 def biplot(siteScores, spScores, siteLabs=None, spLabs=None, xax=1, yax=2, showSp=True, showSite=True, spCol='r',
            siteCol='k', spSize=6, siteSize=6, markersize=4, xlim=None, ylim=None):
     """Biplot sites and species from DCA.
@@ -102,28 +146,31 @@ def biplot(siteScores, spScores, siteLabs=None, spLabs=None, xax=1, yax=2, showS
     Returns:
         None
     """
-    siteScores = pd.DataFrame(siteScores)
-    spScores = pd.DataFrame(spScores)
+    # accept dataframes and lists, but avoid copying arrays
+    siteScores = np.asarray(siteScores)
+
+    # extract the plotted axes once
+    site_x = siteScores[:, xax - 1]
+    site_y = siteScores[:, yax - 1]
 
     f, ax = plt.subplots()
     if showSite:
-        ax.plot(siteScores.iloc[:, xax - 1], siteScores.iloc[:, yax - 1], f'{siteCol}o',
-                ms=markersize, label='Site Scores')
+        ax.plot(site_x, site_y, f'{siteCol}o', ms=markersize, label='Site Scores')
         if siteLabs is not None:
-            [ax.text(x, y, s, fontsize=siteSize, color=siteCol, ha='center', va='bottom') for x, y, s in
-             zip(siteScores.iloc[:, xax - 1], siteScores.iloc[:, yax - 1], siteLabs)]
+            for x, y, s in zip(site_x, site_y, siteLabs):
+                ax.text(x, y, s, fontsize=siteSize, color=siteCol, ha='center', va='bottom')
     if showSp:
-        ax.plot(spScores.iloc[:, xax - 1], spScores.iloc[:, yax - 1], f'{spCol}^',
-                ms=markersize, label='Species Scores')
+        spScores = np.asarray(spScores)
+        sp_x = spScores[:, xax - 1]
+        sp_y = spScores[:, yax - 1]
+        ax.plot(sp_x, sp_y, f'{spCol}^', ms=markersize, label='Species Scores')
         if spLabs is not None:
-            [ax.text(x, y, s, fontsize=spSize, color=spCol, ha='center', va='bottom') for x, y, s in
-             zip(spScores.iloc[:, xax - 1], spScores.iloc[:, yax - 1], spLabs)]
-        xmax = max(np.amax(siteScores.iloc[:, xax - 1]), np.amax(spScores.iloc[:, xax - 1]))
-        xmin = min(np.amin(siteScores.iloc[:, xax - 1]), np.amin(spScores.iloc[:, xax - 1]))
-        ymax = max(np.amax(siteScores.iloc[:, yax - 1]), np.amax(spScores.iloc[:, yax - 1]))
-        ymin = min(np.min(siteScores.iloc[:, yax - 1]), np.min(spScores.iloc[:, yax - 1]))
-        ax.set_xlim([xmin * 1.15, xmax * 1.15])
-        ax.set_ylim([ymin * 1.15, ymax * 1.15])
+            for x, y, s in zip(sp_x, sp_y, spLabs):
+                ax.text(x, y, s, fontsize=spSize, color=spCol, ha='center', va='bottom')
+        x_all = np.concatenate([site_x, sp_x])
+        y_all = np.concatenate([site_y, sp_y])
+        ax.set_xlim([np.amin(x_all) * 1.15, np.amax(x_all) * 1.15])
+        ax.set_ylim([np.amin(y_all) * 1.15, np.amax(y_all) * 1.15])
     if xlim is not None:
         if not isinstance(xlim, list):
             msg = "xlim must be a list"
@@ -140,32 +187,68 @@ def biplot(siteScores, spScores, siteLabs=None, spLabs=None, xax=1, yax=2, showS
     plt.show()
 
 
-def __compile_fortran(path='decorana.f') -> Path:
+def __compile_fortran(path='decorana.f', fast_math=False) -> Path:
     """Compile fortran file to binary executable.
 
+    The program is compiled with optimizations for the current CPU, falling back
+    to a build without -march=native if the target does not support it.
+    Contraction of floating point operations is disabled, so the scores are
+    identical to an unoptimized build, unless fast_math is enabled.
+
+    The executable is cached in the user's cache directory under a name derived
+    from the hash of the source code, compiler flags and machine, so the program
+    is only compiled once per machine.
+
     Args:
         path (str): filename/path of the fortran source code file
+        fast_math (bool): True to compile with -ffast-math, which may change the results slightly
 
     Return:
         (Path): path to the binary executable
     """
+    flags = ['-O3', '-funroll-loops']
+    flags += ['-ffast-math'] if fast_math else ['-ffp-contract=off']
+
+    # reuse the executable if this source code has been compiled before on this machine,
+    # executables built for one CPU may crash on other machines sharing the cache directory
+    build_key = [Path(path).read_bytes(), ' '.join(flags).encode(),
+                 platform.machine().encode(), platform.node().encode()]
+    source_hash = hashlib.sha256(b'\0'.join(build_key)).hexdigest()[:16]
+    cache_dir = Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache')) / 'decorana'
+    executable_path = cache_dir / f'decorana-{source_hash}.exe'
+    if executable_path.exists():
+        return executable_path
+
     # check if fortran compiler exists in path
     if (compiler := shutil.which('gfortran')) is not None:
-        # compile script at path to decorana.exe
-        cwd = Path(os.getcwd())
-        executable_path = cwd / 'decorana.exe'
-        process = subprocess.run([compiler, '-o', executable_path, path],
-                                 stdout=subprocess.DEVNULL,
-                                 stderr=subprocess.DEVNULL)
-        if process.returncode == 0:
-            return executable_path
-        else:
+        with __compile_lock:
+            # another thread may have compiled the program in the meantime
+            if executable_path.exists():
+                return executable_path
+
+            # compile script at path to a temporary file and move it into the cache
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            build_path = cache_dir / f'decorana-{source_hash}.{os.getpid()}-{threading.get_ident()}.tmp'
+            for arch_flags in (['-march=native'], []):
+                process = subprocess.run([compiler, *flags, *arch_flags, '-o', build_path, path],
+                                         stdout=subprocess.DEVNULL,
+                                         stderr=subprocess.DEVNULL)
+                if process.returncode == 0:
+                    try:
+                        os.replace(build_path, executable_path)
+                    except OSError:
+                        # another process may have won the race and be running its executable
+                        build_path.unlink(missing_ok=True)
+                        if not executable_path.exists():
+                            raise
+                    return executable_path
+            build_path.unlink(missing_ok=True)
             raise Exception(f'Compilation of {path} failed!')
     else:
         raise Exception('GNU Fortran compiler is not installed!')
 
 
-def __write_cep(data):
+def __write_cep(data, path='cep.dat'):
     """Converts data matrix to the CEP compressed format.
 
     This function converts a data matrix from normal form, with species as rows
@@ -182,6 +265,7 @@ def __write_cep(data):
 
     Args:
         data (pd.DataFrame): A pandas dataframe
+        path (str): filename/path of the CEP file to write (default = 'cep.dat')
 
     Returns:
         rows (int): number of rows in input dataframe
@@ -195,44 +279,197 @@ def __write_cep(data):
     row_lab = data.index.tolist()
     col_lab = __make_cepnames(data.columns)
 
-    with open('cep.dat', "w") as outfile:
-        title = 'dummy title\n'
-        outfile.write(title)
-
-        data_format = '(I3,5(I3,F3.0))\n'
-        outfile.write(data_format)
-
-        outfile.write("%3d \n" % 5)
-
-        for i in range(rows):
-            number_written = 0
-            row_number_written = False
-            for j in range(columns):
-                if data.iloc[i, j] != 0:
-                    if not row_number_written:
-                        row_number_written = True
-                        outfile.write("%3d" % (i + 1))
-                    outfile.write("%3d%3.0f" % ((j + 1), data.iloc[i, j]))
-                    number_written += 1
-                    if number_written == 5:
-                        outfile.write('\n')
-                        # outfile.write("%3d" % (i + 1))
-                        number_written = 0
-                        row_number_written = False
-            if number_written != 0:
-                outfile.write('\n')
-
-        outfile.write("%3d \n" % 0)
-
-        for j, m in enumerate(col_lab, 1):
-            outfile.write(m + ['', '\n'][j % 10 == 0])
-        outfile.write('\n')
-        for i, m in enumerate(row_lab, 1):
-            outfile.write(str(m).ljust(8) + ['', '\n'][i % 10 == 0])
+    # collect the file contents in memory and write them at once
+    parts = ['dummy title\n', '(I3,5(I3,F3.0))\n', "%3d \n" % 5]
+
+    # locate all non-zero entries, in row-major order
+    counts, jj, vals = __nonzero_entries(data)
+    values, inverse = np.unique(vals, return_inverse=True)
+
+    # format each species number and distinct abundance only once and look them up
+    species_numbers = np.char.mod('%3d', np.arange(1, columns + 1))
+    abundances = np.char.mod('%3.0f', values)
+    couplets = np.char.add(species_numbers[jj], abundances[inverse])
+
+    # add the couplets of each row, five couplets per line
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    for i in np.flatnonzero(counts):
+        start, end = offsets[i], offsets[i + 1]
+        for k in range(start, end, 5):
+            parts.append("%3d" % (i + 1) + ''.join(couplets[k:min(k + 5, end)]) + '\n')
+
+    parts.append("%3d \n" % 0)
+
+    # add the labels in blocks of ten per line
+    row_names = [str(m).ljust(8) for m in row_lab]
+    parts.extend(''.join(col_lab[k:k + 10]) + ['', '\n'][k + 10 <= columns] for k in range(0, columns, 10))
+    parts.append('\n')
+    parts.extend(''.join(row_names[k:k + 10]) + ['', '\n'][k + 10 <= rows] for k in range(0, rows, 10))
+
+    with open(path, "w") as outfile:
+        outfile.write(''.join(parts))
 
     return rows, columns, row_lab, col_lab
 
 
+async def __gather_decorana(datas, max_workers, kwargs):
+    """Runs decorana_async on all dataframes, with at most max_workers running at once.
+
+    Args:
+        datas (list): list of pandas dataframes
+        max_workers (int): maximum number of concurrent runs
+        kwargs (dict): parameters passed to decorana_async
+
+    Returns:
+        results (list): list of decorana results in the order of datas
+    """
+    semaphore = asyncio.Semaphore(max_workers)
+
+    async def run(data):
+        async with semaphore:
+            return await decorana_async(data, **kwargs)
+
+    return await asyncio.gather(*(run(data) for data in datas))
+
+
+def __prepare_run(data, workdir, iweight, iresc, ira, mk, short):
+    """Prepares a decorana run in workdir.
+
+    Args:
+        data (pd.DataFrame): A pandas dataframe
+        workdir (Path): directory the decorana executable is run in
+        iweight, iresc, ira, mk, short (int): parameters of the analysis, see decorana
+
+    Returns:
+        params (bytes): parameters to pass to decorana on stdin
+        nrows (int): number of sites
+        ncols (int): number of species
+        row_lab (list): labels of rows
+        col_lab (list): labels of columns
+    """
+    nrows, ncols, row_lab, col_lab = __write_cep(data, workdir / 'cep.dat')
+    params = __make_params(iweight, iresc, ira, mk, short).encode()
+    return params, nrows, ncols, row_lab, col_lab
+
+
+def __finish_run(returncode, workdir, nrows, ncols):
+    """Checks the exit code of a decorana run and reads its scores from workdir.
+
+    Args:
+        returncode (int): exit code of the decorana executable
+        workdir (Path): directory the decorana executable was run in
+        nrows (int): number of sites
+        ncols (int): number of species
+
+    Returns:
+        site_scores (np.ndarray): array of site scores
+        species_scores (np.ndarray): array of species scores
+    """
+    if returncode != 0:
+        raise Exception(f'decorana.exe exited with code {returncode}!')
+    return __read_output(workdir / 'decorana.out', nrows, ncols)
+
+
+def __make_params(iweight, iresc, ira, mk, short):
+    """Builds the answers to the questions asked by the decorana executable.
+
+    Args:
+        iweight (int): Downweighting of rare species
+        iresc (int): Number of rescaling cycles
+        ira	(int): Type of analysis
+        mk (int): Number of segments in rescaling
+        short (int): Shortest gradient to be rescaled
+
+    Returns:
+        params (str): parameters to pass to decorana on stdin
+    """
+    return f"""cep.dat
+    -1
+    0
+    {iweight}
+    {iresc}
+    {ira}
+    {mk}
+    {short}
+    1
+    0
+    """
+
+
+def __nonzero_entries(data):
+    """Finds the non-zero entries of a data matrix in row-major order.
+
+    Dataframes consisting only of sparse columns with a fill value of 0 are
+    read from their sparse representation, so no dense copy of the matrix is
+    made and memory use is proportional to the number of non-zero entries.
+
+    Args:
+        data (pd.DataFrame): A pandas dataframe
+
+    Returns:
+        counts (np.ndarray): number of non-zero entries per row
+        columns (np.ndarray): column indices of the non-zero entries
+        values (np.ndarray): values of the non-zero entries
+    """
+    rows, columns = data.shape
+    if columns > 0 and all(isinstance(dtype, pd.SparseDtype) and dtype.fill_value == 0 for dtype in data.dtypes):
+        arrays = [data.iloc[:, j].array for j in range(columns)]
+        ii = np.concatenate([a.sp_index.indices for a in arrays])
+        jj = np.repeat(np.arange(columns), [a.sp_index.npoints for a in arrays])
+        vals = np.concatenate([a.sp_values for a in arrays])
+
+        # drop explicitly stored zeros and sort the column-major entries by row
+        nonzero = vals != 0
+        ii, jj, vals = ii[nonzero], jj[nonzero], vals[nonzero]
+        order = np.argsort(ii, kind='stable')
+        return np.bincount(ii, minlength=rows), jj[order], vals[order]
+
+    arr = np.ascontiguousarray(data.to_numpy())
+    mask = arr != 0
+    return mask.sum(axis=1), np.flatnonzero(mask) % columns, arr[mask]
+
+
+def __read_output(path, nrows, ncols):
+    """Reads site and species scores from the decorana output file.
+
+    Each line of the output file is written with the Fortran format (8F10.4),
+    holding four site scores in columns 1-40 and four species scores in
+    columns 41-80.
+
+    Args:
+        path (str): filename/path of decorana.out
+        nrows (int): number of sites
+        ncols (int): number of species
+
+    Returns:
+        site_scores (np.ndarray): array of site scores
+        species_scores (np.ndarray): array of species scores
+    """
+    with open(path, 'rb') as outfile:
+        lines = outfile.read().splitlines()
+    site_scores = __read_scores(lines[:nrows], 0)
+    species_scores = __read_scores(lines[:ncols], 4)
+    return site_scores, species_scores
+
+
+def __read_scores(lines, first_field):
+    """Parses four fixed-width score fields from lines of the decorana output.
+
+    The lines are cut into the eight fields of ten characters each without
+    splitting on whitespace, so adjacent fields without separating blanks are
+    read correctly as well.
+
+    Args:
+        lines (list): lines of decorana.out as bytes
+        first_field (int): index of the first of the four fields to parse
+
+    Returns:
+        scores (np.ndarray): array of scores with one row per line
+    """
+    fields = np.array(lines, dtype='S80').view('S10').reshape(len(lines), 8)
+    return fields[:, first_field:first_field + 4].astype(float)
+
+
 def __make_cepnames(names, seconditem=False):
     """Abbreviates a botanical or zoological Latin name into an eight-character name.
 
@@ -256,21 +493,22 @@ def __make_cepnames(names, seconditem=False):
     Returns:
         cepnames (list): a list of CEP names
     """
+    # abbreviate all names at once
+    parts = pd.Series(list(names), dtype=object).str.split()
+    str1 = parts.str[0]
+    str2 = parts.str[1 if seconditem else -1].fillna(str1)
+    abbreviations = (str1.str[0:4] + str2.str[0:4].str.rstrip('.')).where(str1 != str2, str1.str[0:8])
+
+    # make the names unique by numbering duplicates
     count = 1
     cepnames = list()
-    for name in names:
-        n = len(name.split()) if not seconditem else 2
-        str1 = name.split()[0]
-        try:
-            str2 = name.split()[n - 1]
-        except IndexError:
-            str2 = str1
-        cepstr = str1[0:4] + str2[0:4].rstrip('.') if str1 != str2 else str1[0:8]
-        if cepstr not in cepnames:
-            cepnames.append(cepstr)
-        else:
-            cepnames.append(cepstr[0:7] + str(count))
+    seen = set()
+    for cepstr in abbreviations:
+        if cepstr in seen:
+            cepstr = cepstr[0:7] + str(count)
             count += 1
+        seen.add(cepstr)
+        cepnames.append(cepstr)
     return cepnames
 
 
@@ -278,8 +516,19 @@ def main():
     """Example code for detrended correspondence analysis.
 
     This functions loads a sample dataset, perform the DCA and plot the result as a biplot.
+    The parsed dataset is cached as a pickle file next to the csv file to speed up repeated runs.
     """
-    df = pd.read_csv('./data/gauch.csv', index_col=0)
+    csv_path = Path('./data/gauch.csv')
+    cache_path = csv_path.with_suffix('.pkl')
+    if cache_path.exists() and cache_path.stat().st_mtime >= csv_path.stat().st_mtime:
+        df = pd.read_pickle(cache_path)
+    else:
+        df = pd.read_csv(csv_path, index_col=0)
+        try:
+            df.to_pickle(cache_path)
+        except OSError:
+            # the data directory may be read-only, continue without caching
+            pass
     site_scores, species_scores, site_labels, species_labels = decorana(df)
     biplot(site_scores, species_scores, site_labels, species_labels)
 